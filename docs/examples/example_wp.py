@@ -1,64 +1,85 @@
 import numpy as np
+import matplotlib
+
+# The figures are only saved to disk, so use the non-interactive Agg backend.
+# This avoids loading a GUI toolkit when running headlessly.
+matplotlib.use('Agg')
+
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+from matplotlib.collections import LineCollection
 from halotools.empirical_models import PrebuiltHodModelFactory
 from halotools.mock_observables import wp
 from halotools.sim_manager import CachedHaloCatalog
 from tabcorr import TabCorr
 
-# First, we tabulate the correlation functions in the halo catalog. Note that
-# by default, TabCorr applies redshift-space distortions (RSDs) in the
-# tabulation of correlation functions.
-rp_bins = np.logspace(-1, 1, 20)
-
-halocat = CachedHaloCatalog(simname='bolplanck')
-halotab = TabCorr.tabulate(halocat, wp, rp_bins, pi_max=40, verbose=True,
-                           num_threads=4)
-
-# We can save the result for later use.
-halotab.write('bolplanck_wp.hdf5')
-
-# We could read it in like this. Thus, we can skip the previous steps in the
-# future.
-halotab = TabCorr.read('bolplanck_wp.hdf5')
-
-# Now, we're ready to calculate correlation functions for a specific model.
-model = PrebuiltHodModelFactory('zheng07', threshold=-18)
-
-rp_ave = 0.5 * (rp_bins[1:] + rp_bins[:-1])
-
-ngal, wp = halotab.predict(model)
-plt.plot(rp_ave, wp, label='total')
-
-ngal, wp = halotab.predict(model, separate_gal_type=True)
-for key in wp.keys():
-    plt.plot(rp_ave, wp[key], label=key, ls='--')
-
-plt.xscale('log')
-plt.yscale('log')
-plt.xlabel(r'$r_{\rm p} \ [h^{-1} \ \mathrm{Mpc}]$')
-plt.ylabel(r'$w_{\rm p} \ [h^{-1} \ \mathrm{Mpc}]$')
-plt.legend(loc='lower left', frameon=False)
-plt.tight_layout(pad=0.3)
-plt.savefig('wp_decomposition.png', dpi=300)
-plt.close()
-
-# Studying how the clustering predictions change as a function of galaxy-halo
-# parameters is straightforward.
-sm = mpl.cm.ScalarMappable(
-    cmap=mpl.cm.viridis, norm=mpl.colors.Normalize(vmin=12.0, vmax=12.8))
-
-for logm1 in np.linspace(12.0, 12.8, 1000):
-    model.param_dict['logM1'] = logm1
-    ngal, wp = halotab.predict(model)
-    plt.plot(rp_ave, wp, color=sm.to_rgba(logm1), lw=0.1)
-
-cb = plt.colorbar(sm, ax=plt.gca())
-cb.set_label(r'$\log M_1$')
-plt.xscale('log')
-plt.yscale('log')
-plt.xlabel(r'$r_{\rm p} \ [h^{-1} \ \mathrm{Mpc}]$')
-plt.ylabel(r'$w_{\rm p} \ [h^{-1} \ \mathrm{Mpc}]$')
-plt.tight_layout(pad=0.3)
-plt.savefig('wp_vs_logm1.png', dpi=300)
-plt.close()
+
+def main():
+
+    # First, we tabulate the correlation functions in the halo catalog. Note
+    # that by default, TabCorr applies redshift-space distortions (RSDs) in
+    # the tabulation of correlation functions.
+    rp_bins = np.logspace(-1, 1, 20)
+
+    halocat = CachedHaloCatalog(simname='bolplanck')
+    halotab = TabCorr.tabulate(halocat, wp, rp_bins, pi_max=40, verbose=True,
+                               num_threads=4)
+
+    # We can save the result for later use.
+    halotab.write('bolplanck_wp.hdf5')
+
+    # We could read it in like this. Thus, we can skip the previous steps in
+    # the future.
+    halotab = TabCorr.read('bolplanck_wp.hdf5')
+
+    # Now, we're ready to calculate correlation functions for a specific
+    # model.
+    model = PrebuiltHodModelFactory('zheng07', threshold=-18)
+
+    rp_ave = 0.5 * (rp_bins[1:] + rp_bins[:-1])
+
+    ngal, wp_model = halotab.predict(model)
+    plt.plot(rp_ave, wp_model, label='total')
+
+    ngal, wp_model = halotab.predict(model, separate_gal_type=True)
+    for key in wp_model.keys():
+        plt.plot(rp_ave, wp_model[key], label=key, ls='--')
+
+    plt.xscale('log')
+    plt.yscale('log')
+    plt.xlabel(r'$r_{\rm p} \ [h^{-1} \ \mathrm{Mpc}]$')
+    plt.ylabel(r'$w_{\rm p} \ [h^{-1} \ \mathrm{Mpc}]$')
+    plt.legend(loc='lower left', frameon=False)
+    plt.tight_layout(pad=0.3)
+    plt.savefig('wp_decomposition.png', dpi=300)
+    plt.close()
+
+    # Studying how the clustering predictions change as a function of
+    # galaxy-halo parameters is straightforward.
+    sm = mpl.cm.ScalarMappable(
+        cmap=mpl.cm.viridis, norm=mpl.colors.Normalize(vmin=12.0, vmax=12.8))
+
+    logm1 = np.linspace(12.0, 12.8, 1000)
+    ngal, wp_model = halotab.predict_grid(model, 'logM1', logm1)
+
+    # Adding all lines at once via a single LineCollection is much faster
+    # than 1000 individual plt.plot calls.
+    ax = plt.gca()
+    ax.add_collection(LineCollection(
+        [np.column_stack([rp_ave, wp_i]) for wp_i in wp_model],
+        colors=sm.to_rgba(logm1), linewidths=0.1))
+    ax.autoscale()
+
+    cb = plt.colorbar(sm, ax=ax)
+    cb.set_label(r'$\log M_1$')
+    plt.xscale('log')
+    plt.yscale('log')
+    plt.xlabel(r'$r_{\rm p} \ [h^{-1} \ \mathrm{Mpc}]$')
+    plt.ylabel(r'$w_{\rm p} \ [h^{-1} \ \mathrm{Mpc}]$')
+    plt.tight_layout(pad=0.3)
+    plt.savefig('wp_vs_logm1.png', dpi=300)
+    plt.close()
+
+
+if __name__ == '__main__':
+    main()
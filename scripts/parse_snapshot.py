@@ -1,29 +1,129 @@
 import argparse
 import gc
+import h5py
 import io
+import mmap
 import numpy as np
 import os
 import requests
 import struct
+import tempfile
 
 from abacusnbody.data.read_abacus import read_asdf
 from abacusnbody.data.compaso_halo_catalog import CompaSOHaloCatalog
 from astropy import units as u
 from astropy.cosmology import w0waCDM
 from astropy.table import Table, vstack
-from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from halotools.empirical_models import delta_vir
 from pathlib import Path
+from requests.adapters import HTTPAdapter, Retry
 from tabcorr import database
 from tqdm import tqdm
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 ABACUS_SUMMIT_PATH_BASE = Path('/global/cfs/cdirs/desi/cosmosim/Abacus')
 
+RNG = np.random.default_rng()
+
+# Backing directory for memory-mapped scratch files. Prefer tmpfs so the
+# pages never hit disk but can be reclaimed by the OS under memory pressure.
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+AEMULUS_ALPHA_SCALE_FACTORS = np.array(
+    [0.25, 0.333333, 0.5, 0.540541, 0.588235, 0.645161, 0.714286, 0.8,
+     0.909091, 1.0])
+AEMULUS_ALPHA_REDSHIFTS = 1 / AEMULUS_ALPHA_SCALE_FACTORS - 1
+
+# Layout of the 256-byte Gadget-2 header, matching the struct format string
+# '6I6dddii6Iiiddddii6Ii'.
+GADGET_HEADER_DTYPE = np.dtype([
+    ('npart', '6u4'), ('mass', '6f8'), ('time', 'f8'), ('redshift', 'f8'),
+    ('flag_sfr', 'i4'), ('flag_feedback', 'i4'), ('npartTotal', '6u4'),
+    ('flag_cooling', 'i4'), ('num_files', 'i4'), ('BoxSize', 'f8'),
+    ('Omega0', 'f8'), ('OmegaLambda', 'f8'), ('HubbleParam', 'f8'),
+    ('flag_age', 'i4'), ('flag_metals', 'i4'), ('NallHW', '6u4'),
+    ('flag_entr_ics', 'i4')])
+
+
+class SkipReader:
+    """Wrapper emulating relative forward seeks on a non-seekable stream.
+
+    `read_gadget_snapshot` only ever reads forward and skips blocks via
+    relative seeks, so a raw HTTP response body can be parsed on the fly by
+    translating those seeks into reads that discard the data.
+
+    """
+
+    def __init__(self, fstream):
+        self._fstream = fstream
+
+    def read(self, size):
+        data = self._fstream.read(size)
+        while len(data) < size:
+            data_tmp = self._fstream.read(size - len(data))
+            if not data_tmp:
+                break
+            data += data_tmp
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence != 1 or offset < 0:
+            raise ValueError('Only relative forward seeks are supported.')
+        self.read(offset)
+
+
+def subsample_xyz(pos, idx):
+    """Gather a subsample of (N, 3) positions into float32 x/y/z arrays.
+
+    If numba is available, the gather, the split into contiguous
+    coordinate arrays and the cast to float32 are fused into a single
+    pass over the selected rows that runs without holding the GIL, so
+    the download workers can subsample concurrently on multiple cores.
+
+    Parameters
+    ----------
+    pos : numpy.ndarray
+        Array of shape (N, 3) containing the positions.
+    idx : numpy.ndarray
+        Indices of the rows to keep.
+
+    Returns
+    -------
+    x, y, z : numpy.ndarray
+        Contiguous float32 arrays containing the selected coordinates.
+
+    """
+    if numba is None:
+        pos = pos[idx].astype(np.float32, copy=False)
+        return (np.ascontiguousarray(pos[:, 0]),
+                np.ascontiguousarray(pos[:, 1]),
+                np.ascontiguousarray(pos[:, 2]))
+    return _subsample_xyz_numba(pos, idx)
+
+
+if numba is not None:
+
+    @numba.njit(nogil=True, cache=True)
+    def _subsample_xyz_numba(pos, idx):
+        x = np.empty(len(idx), dtype=np.float32)
+        y = np.empty(len(idx), dtype=np.float32)
+        z = np.empty(len(idx), dtype=np.float32)
+        for i in range(len(idx)):
+            x[i] = pos[idx[i], 0]
+            y[i] = pos[idx[i], 1]
+            z[i] = pos[idx[i], 2]
+        return x, y, z
+
 
 def read_gadget_snapshot(bstream, read_pos=False, read_vel=False,
                          read_id=False, read_mass=False, print_header=False,
-                         single_type=-1, lgadget=False):
+                         single_type=-1, lgadget=False, soa=False):
     """
     Read a Gadget-2 snapshot file.
 
@@ -32,8 +132,9 @@ def read_gadget_snapshot(bstream, read_pos=False, read_vel=False,
 
     Parameters
     ----------
-    bstream : io.BytesIO
-        Binary stream of the gadget snapshot file.
+    bstream : io.BytesIO or file-like object
+        Binary stream of the gadget snapshot file. Only needs to support
+        reads and relative forward seeks.
     read_pos : bool, optional
         Whether to read the positions or not. Default is false.
     read_vel : bool, optional
@@ -50,46 +151,42 @@ def read_gadget_snapshot(bstream, read_pos=False, read_vel=False,
     lgadget : bool, optional
         Set to True if the particle file comes from l-gadget.
         Default is false.
+    soa : bool, optional
+        If True, positions and velocities are returned as tuples of three
+        contiguous arrays (x, y, z) instead of a single (N, 3) array.
+        Default is false.
 
     Returns
     -------
     ret : tuple
         A tuple of the requested data.
         The first item in the returned tuple is always the header.
-        The header is in the gadget_header namedtuple format.
+        The header is a numpy structured scalar with the fields of
+        GADGET_HEADER_DTYPE.
 
     """
-    gadget_header_fmt = '6I6dddii6Iiiddddii6Ii'
-
-    gadget_header = namedtuple(
-        'gadget_header', 'npart mass time redshift flag_sfr flag_feedback ' +
-        'npartTotal flag_cooling num_files BoxSize Omega0 OmegaLambda ' +
-        'HubbleParam flag_age flag_metals NallHW flag_entr_ics')
-
     blocks_to_read = (read_pos, read_vel, read_id, read_mass)
     ret = []
 
     bstream.seek(4, 1)
-    h = list(struct.unpack(gadget_header_fmt,
-             bstream.read(struct.calcsize(gadget_header_fmt))))
+    header = np.frombuffer(bstream.read(GADGET_HEADER_DTYPE.itemsize),
+                           dtype=GADGET_HEADER_DTYPE, count=1).copy()[0]
     if lgadget:
-        h[30] = 0
-        h[31] = h[18]
-        h[18] = 0
+        header['NallHW'][0] = 0
+        header['NallHW'][1] = header['npartTotal'][2]
+        header['npartTotal'][2] = 0
         single_type = 1
-    h = tuple(h)
-    header = gadget_header._make(
-        (h[0:6],) + (h[6:12],) + h[12:16] + (h[16:22],) + h[22:30] +
-        (h[30:36],) + h[36:])
     if print_header:
         print(header)
     if not any(blocks_to_read):
         return header
+    last_block = max(i for i, b in enumerate(blocks_to_read) if b)
     ret.append(header)
-    bstream.seek(256 - struct.calcsize(gadget_header_fmt), 1)
+    bstream.seek(256 - GADGET_HEADER_DTYPE.itemsize, 1)
     bstream.seek(4, 1)
 
-    mass_npart = [0 if m else n for m, n in zip(header.mass, header.npart)]
+    mass_npart = [0 if m else n for m, n in zip(header['mass'],
+                                                header['npart'])]
     if single_type not in set(range(6)):
         single_type = -1
 
@@ -97,7 +194,7 @@ def read_gadget_snapshot(bstream, read_pos=False, read_vel=False,
         fmt = np.dtype(np.float32)
         fmt_64 = np.dtype(np.float64)
         item_per_part = 1
-        npart = header.npart
+        npart = header['npart']
 
         if i < 2:
             item_per_part = 3
@@ -130,9 +227,14 @@ def read_gadget_snapshot(bstream, read_pos=False, read_vel=False,
             data = np.frombuffer(bstream.read(npart_this*size_per_part), fmt)
             if item_per_part > 1:
                 data.shape = (npart_this, item_per_part)
+                if soa:
+                    data = tuple(np.ascontiguousarray(data[:, k])
+                                 for k in range(item_per_part))
             ret.append(data)
-            if not any(blocks_to_read[i+1:]):
-                break
+            if i == last_block:
+                # Return without walking the remaining blocks. For streamed
+                # input, this also avoids downloading their bytes.
+                return tuple(ret)
             if single_type > -1:
                 bstream.seek(sum(npart[single_type+1:])*size_per_part, 1)
         bstream.seek(4, 1)
@@ -140,86 +242,214 @@ def read_gadget_snapshot(bstream, read_pos=False, read_vel=False,
     return tuple(ret)
 
 
-def download_aemulus_alpha_halos(simulation, redshift):
+AEMULUS_AUTH = None
+AEMULUS_SESSION = None
+
+
+def aemulus_alpha_auth():
+    global AEMULUS_AUTH
+    if AEMULUS_AUTH is None:
+        try:
+            AEMULUS_AUTH = requests.auth.HTTPBasicAuth(
+                os.environ['AEMULUS_USERNAME'],
+                os.environ['AEMULUS_PASSWORD'])
+        except KeyError:
+            raise RuntimeError("Set the AEMULUS_USERNAME and " +
+                               "AEMULUS_PASSWORD environment variables.")
+    return AEMULUS_AUTH
 
-    try:
-        username = os.environ['AEMULUS_USERNAME']
-        password = os.environ['AEMULUS_PASSWORD']
-    except KeyError:
-        raise RuntimeError("Set the AEMULUS_USERNAME and AEMULUS_PASSWORD " +
-                           "environment variables.")
 
-    scale_factor_snapshots = np.array([0.25, 0.333333, 0.5, 0.540541, 0.588235,
-                                       0.645161, 0.714286, 0.8, 0.909091, 1.0])
-    redshift_snapshots = 1 / scale_factor_snapshots - 1
+def aemulus_alpha_session():
+    # A shared session reuses connections across all requests and retries
+    # transient server errors with exponential backoff, so a single 5xx does
+    # not abort a multi-hour download.
+    global AEMULUS_SESSION
+    if AEMULUS_SESSION is None:
+        AEMULUS_SESSION = requests.Session()
+        AEMULUS_SESSION.mount('https://', HTTPAdapter(
+            pool_connections=32, pool_maxsize=32,
+            max_retries=Retry(total=5, backoff_factor=0.3,
+                              status_forcelist=[502, 503, 504])))
+        AEMULUS_SESSION.auth = aemulus_alpha_auth()
+    return AEMULUS_SESSION
 
-    try:
-        assert np.amin(np.abs(redshift_snapshots - redshift)) < 0.005
-    except AssertionError:
+
+def aemulus_alpha_snapnum(redshift):
+
+    snapnum = int(np.argmin(np.abs(AEMULUS_ALPHA_REDSHIFTS - redshift)))
+
+    if np.abs(AEMULUS_ALPHA_REDSHIFTS[snapnum] - redshift) >= 0.005:
         raise ValueError('No snapshot for redshift {:.2f}.'.format(redshift))
 
-    snapnum = np.argmin(np.abs(redshift_snapshots - redshift))
+    return snapnum
 
-    url = ("https://www.slac.stanford.edu/~jderose/aemulus/phase1/" +
-           "{}/halos/m200b/outbgc2_{}.list".format(simulation, snapnum))
 
-    r = requests.get(url, auth=requests.auth.HTTPBasicAuth(username, password))
-    halos = Table.read(io.BytesIO(r.content), format='ascii', delimiter=' ')
+def read_gadget_positions_f32(bstream):
+    """Read only the positions from a single-precision Gadget-2 snapshot.
 
-    url = url.replace('outbgc2', 'out')
-    r = requests.get(url, auth=requests.auth.HTTPBasicAuth(username, password))
-    halos['halo_rs'] = Table.read(
-        io.BytesIO(r.content), format='ascii', delimiter=' ')['col7'] / 1e3
-    halos['R200b'] /= 1e3
+    Specialized fast path equivalent to
+    ``read_gadget_snapshot(bstream, read_pos=True)[1]`` that assumes
+    float32 positions for all particle types, as written by the Aemulus
+    Alpha snapshots, and therefore skips the per-block dtype probing of
+    the general parser.
 
-    halos.rename_column('M200b', 'halo_m200m')
-    halos.rename_column('R200b', 'halo_r200m')
-    halos.rename_column('Vmax', 'halo_vmax')
-    for coordinate in ['x', 'y', 'z', 'vx', 'vy', 'vz']:
-        halos.rename_column(coordinate.upper(), 'halo_{}'.format(coordinate))
+    Parameters
+    ----------
+    bstream : io.BytesIO or file-like object
+        Binary stream of the gadget snapshot file. Only needs to support
+        reads and relative forward seeks.
 
-    halos = halos[halos['Parent_ID'] == -1]
+    Returns
+    -------
+    pos : numpy.ndarray
+        Array of shape (N, 3) containing the positions.
 
-    halos.keep_columns([col for col in halos.colnames if col[:5] == 'halo_'])
+    Raises
+    ------
+    ValueError
+        If the position block is not single precision.
 
-    return halos
+    """
+    bstream.seek(4, 1)
+    header = np.frombuffer(bstream.read(GADGET_HEADER_DTYPE.itemsize),
+                           dtype=GADGET_HEADER_DTYPE, count=1)[0]
+    bstream.seek(256 - GADGET_HEADER_DTYPE.itemsize, 1)
+    bstream.seek(4, 1)
 
+    npart = int(np.sum(header['npart']))
+    size_check = struct.unpack('I', bstream.read(4))[0]
+    if size_check != 12 * npart:
+        raise ValueError('Expected a single-precision position block.')
 
-def download_aemulus_alpha_particles(simulation, redshift):
+    pos = np.frombuffer(bstream.read(12 * npart), np.float32)
+    pos.shape = (npart, 3)
+    return pos
 
-    try:
-        username = os.environ['AEMULUS_USERNAME']
-        password = os.environ['AEMULUS_PASSWORD']
-    except KeyError:
-        raise RuntimeError("Set the AEMULUS_USERNAME and AEMULUS_PASSWORD " +
-                           "environment variables.")
 
-    scale_factor_snapshots = np.array([0.25, 0.333333, 0.5, 0.540541, 0.588235,
-                                       0.645161, 0.714286, 0.8, 0.909091, 1.0])
-    redshift_snapshots = 1 / scale_factor_snapshots - 1
+def download_aemulus_alpha_halos(simulation, redshift):
 
-    try:
-        assert np.amin(np.abs(redshift_snapshots - redshift)) < 0.005
-    except AssertionError:
-        raise ValueError('No snapshot for redshift {:.2f}.'.format(redshift))
+    session = aemulus_alpha_session()
+    snapnum = aemulus_alpha_snapnum(redshift)
 
-    snapnum = np.argmin(np.abs(redshift_snapshots - redshift))
+    url = ("https://www.slac.stanford.edu/~jderose/aemulus/phase1/" +
+           "{}/halos/m200b/outbgc2_{}.list".format(simulation, snapnum))
 
-    ptcls = np.zeros((0, 3))
+    r = session.get(url)
+    halos = Table.read(io.BytesIO(r.content), format='ascii', delimiter=' ')
 
-    for chunk in tqdm(range(512)):
-        url = ("https://www.slac.stanford.edu/~jderose/aemulus/phase1/" +
-               "{}/output/snapdir_{:03}/snapshot_{:03}.{}".format(
-                   simulation, snapnum, snapnum, chunk))
-        r = requests.get(
-            url, auth=requests.auth.HTTPBasicAuth(username, password))
-        ptcls_tmp = read_gadget_snapshot(
-            io.BytesIO(r.content), read_pos=True)[1]
-        ptcls_tmp = ptcls_tmp[np.random.random(len(ptcls_tmp)) < 0.01]
-        ptcls = np.vstack([ptcls, ptcls_tmp])
+    url = url.replace('outbgc2', 'out')
+    r = session.get(url)
+    halos['halo_rs'] = Table.read(
+        io.BytesIO(r.content), format='ascii', delimiter=' ')['col7'] / 1e3
+    halos['R200b'] /= 1e3
+
+    rename = {'M200b': 'halo_m200m', 'R200b': 'halo_r200m',
+              'Vmax': 'halo_vmax'}
+    for coordinate in ['x', 'y', 'z', 'vx', 'vy', 'vz']:
+        rename[coordinate.upper()] = 'halo_{}'.format(coordinate)
+
+    arr = halos.as_array()
+    arr.dtype.names = tuple(rename.get(name, name) for name in
+                            arr.dtype.names)
+    arr = arr[arr['Parent_ID'] == -1]
+    arr = arr[[name for name in arr.dtype.names if name[:5] == 'halo_']]
+
+    return Table(arr)
+
+
+def aemulus_alpha_chunk_url(simulation, snapnum, chunk):
+    return ("https://www.slac.stanford.edu/~jderose/aemulus/phase1/" +
+            "{}/output/snapdir_{:03}/snapshot_{:03}.{}".format(
+                simulation, snapnum, snapnum, chunk))
+
+
+def subsample_chunk(bstream):
+    ptcls = read_gadget_positions_f32(bstream)
+    n = len(ptcls)
+    idx = RNG.choice(n, size=RNG.binomial(n, 0.01), replace=False)
+    return subsample_xyz(ptcls, idx)
+
+
+def subsample_chunk_buffer(buf):
+    # Zero-copy variant of subsample_chunk for in-memory buffers: the header
+    # and the position block are viewed in place via np.frombuffer offsets
+    # instead of being read into fresh bytes objects. No view into `buf` may
+    # be alive when raising, since the traceback would keep it referenced and
+    # closing the memory map would fail with a BufferError.
+    npart = int(np.frombuffer(buf, dtype=GADGET_HEADER_DTYPE, count=1,
+                              offset=4)['npart'].sum())
+    size_check = int(np.frombuffer(buf, dtype=np.uint32, count=1,
+                                   offset=4 + 256 + 4)[0])
+    if size_check != 12 * npart:
+        raise ValueError('Expected a single-precision position block.')
+    ptcls = np.frombuffer(buf, dtype=np.float32, count=3 * npart,
+                          offset=4 + 256 + 4 + 4)
+    ptcls.shape = (npart, 3)
+    idx = RNG.choice(npart, size=RNG.binomial(npart, 0.01), replace=False)
+    return subsample_xyz(ptcls, idx)
+
+
+def download_aemulus_alpha_chunks_async(simulation, snapnum, username,
+                                        password):
+    # Multiplex the 512 requests over a few HTTP/2 connections instead of
+    # paying one TCP+TLS handshake per chunk. httpx is only required when
+    # this path is requested.
+    import asyncio
+    import httpx
+
+    async def fetch(client, chunk):
+        r = await client.get(
+            aemulus_alpha_chunk_url(simulation, snapnum, chunk))
+        r.raise_for_status()
+        # Spill the response body to a memory-mapped tmpfs file so the bytes
+        # object can be freed before parsing and the mapped pages stay
+        # reclaimable while other chunks are in flight.
+        with tempfile.TemporaryFile(dir=SHM_DIR) as fstream:
+            fstream.write(r.content)
+            del r
+            fstream.flush()
+            with mmap.mmap(fstream.fileno(), 0,
+                           access=mmap.ACCESS_READ) as buf:
+                return subsample_chunk_buffer(buf)
+
+    async def fetch_all():
+        async with httpx.AsyncClient(
+                http2=True, auth=(username, password),
+                limits=httpx.Limits(max_connections=16),
+                timeout=None) as client:
+            tasks = [fetch(client, chunk) for chunk in range(512)]
+            return [await coro for coro in
+                    tqdm(asyncio.as_completed(tasks), total=512)]
+
+    return asyncio.run(fetch_all())
+
+
+def download_aemulus_alpha_particles(simulation, redshift, use_async=False):
+
+    auth = aemulus_alpha_auth()
+    snapnum = aemulus_alpha_snapnum(redshift)
+
+    if use_async:
+        ptcls = download_aemulus_alpha_chunks_async(
+            simulation, snapnum, auth.username, auth.password)
+    else:
+        session = aemulus_alpha_session()
 
-    return Table([ptcls[:, 0], ptcls[:, 1], ptcls[:, 2]],
-                 names=('x', 'y', 'z'))
+        def fetch(chunk):
+            url = aemulus_alpha_chunk_url(simulation, snapnum, chunk)
+            with session.get(url, stream=True) as r:
+                return subsample_chunk(SkipReader(r.raw))
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            ptcls = list(tqdm(executor.map(fetch, range(512)), total=512))
+
+    n = sum(len(p[0]) for p in ptcls)
+    arr = np.empty(n, dtype=[
+        ('x', np.float32), ('y', np.float32), ('z', np.float32)])
+    for i, key in enumerate(['x', 'y', 'z']):
+        np.concatenate([p[i] for p in ptcls], out=arr[key])
+
+    return Table(arr, copy=False)
 
 
 def read_abacus_summit_halos(simulation, redshift):
@@ -311,6 +541,9 @@ def main():
                         help='simulation configuration to assume')
     parser.add_argument('--particles', action='store_true',
                         help='whether to download particles instead of halos')
+    parser.add_argument('--use_async', action='store_true',
+                        help='whether to download particle chunks over ' +
+                        'HTTP/2 via httpx instead of a thread pool')
 
     args = parser.parse_args()
 
@@ -333,13 +566,29 @@ def main():
     else:
         subpath = 'particles'
         if args.suite == 'AemulusAlpha':
-            data = download_aemulus_alpha_particles(name, args.redshift)
+            data = download_aemulus_alpha_particles(
+                name, args.redshift, use_async=args.use_async)
         else:
             data = read_abacus_summit_particles(name, args.redshift)
 
     print('Writing results to {}.'.format(path / 'snapshot.hdf5'))
-    data.write(path / 'snapshot.hdf5', path=subpath, overwrite=True,
-               append=True)
+    if subpath == 'particles':
+        # Shuffled LZF compression shrinks the float32 positions
+        # considerably compared to astropy's uncompressed default, and the
+        # dataset layout stays readable via Table.read(..., path=subpath).
+        ptcls = np.empty(len(data), dtype=[
+            ('x', np.float32), ('y', np.float32), ('z', np.float32)])
+        for key in ['x', 'y', 'z']:
+            ptcls[key] = data[key]
+        with h5py.File(path / 'snapshot.hdf5', 'a') as fstream:
+            if subpath in fstream:
+                del fstream[subpath]
+            fstream.create_dataset(
+                subpath, data=ptcls, chunks=(min(len(ptcls), 2**20), ),
+                compression='lzf', shuffle=True)
+    else:
+        data.write(path / 'snapshot.hdf5', path=subpath, overwrite=True,
+                   append=True)
     print('Done!')
 
 
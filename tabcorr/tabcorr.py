@@ -568,6 +568,30 @@ class TabCorr:
             self.w_gauss * mean_occupation * prim_haloprop**n, axis=-1) /
             np.sum(self.w_gauss * prim_haloprop**n, axis=-1))
 
+    def _compute_ngal_sq_indices(self):
+        """Lazily compute the index pairs of the flattened auto-correlation.
+
+        The results are cached in the `ngal_sq_index_1`, `ngal_sq_index_2`
+        and `ngal_sq_prefactor` attributes.
+
+        """
+        if hasattr(self, 'ngal_sq_index_1'):
+            return
+
+        n_bins = len(self.gal_type)
+        ngal_sq_index_1 = np.repeat(np.arange(n_bins), n_bins).reshape(
+            n_bins, n_bins)
+        ngal_sq_index_2 = np.tile(np.arange(n_bins), n_bins).reshape(
+            n_bins, n_bins)
+
+        self.ngal_sq_index_1 = symmetric_matrix_to_array(
+            ngal_sq_index_1, check_symmetry=False)
+        self.ngal_sq_index_2 = symmetric_matrix_to_array(
+            ngal_sq_index_2, check_symmetry=False)
+
+        self.ngal_sq_prefactor = np.where(
+            self.ngal_sq_index_1 == self.ngal_sq_index_2, 1, 2)
+
     def predict(self, model, separate_gal_type=False, n_gauss_prim=10,
                 **occ_kwargs):
         """Predict the number density and correlation function for a model.
@@ -609,21 +633,7 @@ class TabCorr:
         ngal = mean_occupation * self.gal_type['n_h'].data
 
         if self.attrs['mode'] == 'auto':
-            if not hasattr(self, 'ngal_sq_index_1'):
-                n_bins = len(self.gal_type)
-                ngal_sq_index_1 = np.repeat(np.arange(n_bins), n_bins).reshape(
-                    n_bins, n_bins)
-                ngal_sq_index_2 = np.tile(np.arange(n_bins), n_bins).reshape(
-                    n_bins, n_bins)
-
-                self.ngal_sq_index_1 = symmetric_matrix_to_array(
-                    ngal_sq_index_1, check_symmetry=False)
-                self.ngal_sq_index_2 = symmetric_matrix_to_array(
-                    ngal_sq_index_2, check_symmetry=False)
-
-                self.ngal_sq_prefactor = np.where(
-                    self.ngal_sq_index_1 == self.ngal_sq_index_2, 1, 2)
-
+            self._compute_ngal_sq_indices()
             ngal_sq = (self.ngal_sq_prefactor * ngal[self.ngal_sq_index_1] *
                        ngal[self.ngal_sq_index_2])
 
@@ -668,6 +678,69 @@ class TabCorr:
 
         return ngal_dict, xi_dict
 
+    def predict_grid(self, model, param_name, param_values, n_gauss_prim=10,
+                     **occ_kwargs):
+        """Predict number densities and correlation functions on a grid.
+
+        This is equivalent to repeatedly updating `param_name` in the
+        parameter dictionary of the model and calling `predict`. However, the
+        correlation functions for all parameter values are obtained via a
+        single matrix multiplication, which is substantially faster for fine
+        grids.
+
+        Parameters
+        ----------
+        model : HodModelFactory
+            Instance of ``halotools.empirical_models.HodModelFactory``
+            describing the model for which predictions are made.
+        param_name : string
+            Name of the entry in the parameter dictionary of the model that
+            is varied.
+        param_values : numpy.ndarray
+            Values of the parameter for which predictions are made.
+        n_gauss_prim : int, optional
+            The number of points used in the Gaussian quadrature to calculate
+            the mean occupation averaged over the primary halo property in
+            each halo bin. Default is 10.
+        **occ_kwargs : dict, optional
+            Keyword arguments passed to the ``mean_occupation`` functions of
+            the model.
+
+        Returns
+        -------
+        ngal : numpy.ndarray
+            Galaxy number densities, one for each parameter value.
+        xi : numpy.ndarray
+            Correlation function values. The first axis runs over the
+            parameter values.
+
+        """
+        param_value_orig = model.param_dict[param_name]
+        mean_occupation = np.empty((len(param_values), len(self.gal_type)))
+        try:
+            for i, param_value in enumerate(param_values):
+                model.param_dict[param_name] = param_value
+                mean_occupation[i] = self.mean_occupation(
+                    model, n_gauss_prim=n_gauss_prim, **occ_kwargs)
+        finally:
+            model.param_dict[param_name] = param_value_orig
+
+        ngal = mean_occupation * self.gal_type['n_h'].data
+
+        if self.attrs['mode'] == 'auto':
+            self._compute_ngal_sq_indices()
+            ngal_sq = (self.ngal_sq_prefactor *
+                       ngal[:, self.ngal_sq_index_1] *
+                       ngal[:, self.ngal_sq_index_2])
+            xi = (np.einsum('ij, kj', self.tpcf_matrix, ngal_sq).T /
+                  np.sum(ngal_sq, axis=1)[:, np.newaxis])
+        elif self.attrs['mode'] == 'cross':
+            xi = (np.einsum('ij, kj', self.tpcf_matrix, ngal).T /
+                  np.sum(ngal, axis=1)[:, np.newaxis])
+
+        return (np.sum(ngal, axis=1),
+                xi.reshape((len(param_values), ) + self.tpcf_shape))
+
 
 def sort_into_bins(log_prim_haloprop, log_prim_haloprop_bins,
                    sec_haloprop_percentile, sec_haloprop_percentile_bins,